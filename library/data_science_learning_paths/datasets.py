@@ -1,31 +1,340 @@
+import atexit
+import functools
+import glob
+import hashlib
+import inspect
+import json
 import os
+import shutil
 import subprocess
 import zipfile
 
 import numpy
 import pandas
 
+# default CSV parse backend for all read_* functions: "c" or "pyarrow"
+csv_engine = "c"
+# directory for datasets shared between processes, e.g. "/dev/shm/dslp", None reads
+# every dataset in every process. With the cache, read_* functions return frames
+# whose columns are read-only and whose string columns are categorical: replacing
+# a column works, modifying values in place needs a .copy() first.
+shared_cache_dir = os.environ.get("DSLP_SHARED_CACHE")
+# unreferenced datasets are evicted when the shared cache grows beyond this size
+shared_cache_max_bytes = 2 * 1024**3
 
-def read_usa_temperature(data_path="../.assets/data/climate/usa-avg-temp-monthly.csv"):
+_shared_refs = set()  # shared cache keys referenced by this process
+
+
+def _read_csv(
+    data_path, engine=None, sep=",", usecols=None, dtype=None, parse_dates=None
+):
+    """
+    Read a CSV file with the selected parse backend. The "pyarrow" engine
+    parses multithreaded and requires the optional pyarrow package.
+    """
+    if engine is None:
+        engine = csv_engine
+    if engine == "c":
+        return pandas.read_csv(
+            data_path,
+            engine="c",
+            sep=sep,
+            usecols=usecols,
+            dtype=dtype,
+            parse_dates=parse_dates,
+        )
+    elif engine == "pyarrow":
+        # pandas' own pyarrow engine keeps empty and "NA" strings as values
+        import pyarrow
+        from pyarrow import csv
+
+        column_types = {
+            column: pyarrow.from_numpy_dtype(numpy.dtype(column_dtype))
+            for column, column_dtype in (dtype or {}).items()
+        }
+        for column in parse_dates or []:
+            column_types[column] = pyarrow.timestamp("ns")
+        table = csv.read_csv(
+            data_path,
+            parse_options=csv.ParseOptions(delimiter=sep),
+            convert_options=csv.ConvertOptions(
+                column_types=column_types,
+                include_columns=usecols,
+                strings_can_be_null=True,
+            ),
+        )
+        return table.to_pandas()
+    else:
+        raise ValueError(f"unsupported CSV engine: {engine}")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _live_refs(key):
+    refs_dir = os.path.join(shared_cache_dir, f"{key}.refs")
+    live = 0
+    for ref_path in glob.glob(os.path.join(refs_dir, "*")):
+        if _pid_alive(int(os.path.basename(ref_path))):
+            live += 1
+        else:
+            # process ended without releasing its reference
+            os.remove(ref_path)
+    return live
+
+
+def _release_shared_refs():
+    for key in _shared_refs:
+        try:
+            os.remove(os.path.join(shared_cache_dir, f"{key}.refs", str(os.getpid())))
+        except OSError:
+            pass
+
+
+atexit.register(_release_shared_refs)
+
+
+def _lock_shared(key, blocking=True):
+    """
+    Open and lock the lock file of a shared dataset, return None if blocking
+    is False and another process holds the lock
+    """
+    import fcntl
+
+    lock_path = os.path.join(shared_cache_dir, f"{key}.lock")
+    while True:
+        lock = open(lock_path, "a")
+        try:
+            fcntl.flock(
+                lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            lock.close()
+            return None
+        # eviction may have removed the file while this process was waiting
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def _write_shared_part(data, table_path):
+    """
+    Write a frame or series as an Arrow file that processes can map without
+    copying, return what is needed to restore it
+    """
+    import pyarrow
+
+    meta = {"series": isinstance(data, pandas.Series), "name": None, "freq": None}
+    if meta["series"]:
+        meta["name"] = data.name
+        data = data.to_frame(name="__series__")
+    meta["freq"] = getattr(data.index, "freqstr", None)
+    data = data.copy(deep=False)
+    for column in data.columns:
+        if (
+            not isinstance(data[column].dtype, pandas.CategoricalDtype)
+            and pandas.api.types.infer_dtype(data[column], skipna=True) == "string"
+        ):
+            # dictionary-encoded strings map as shared codes instead of
+            # becoming Python objects in every process
+            data[column] = data[column].astype("category")
+    table = pyarrow.Table.from_pandas(data)
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_floating(field.type) and table.column(i).null_count:
+            # NaN values instead of nulls keep the column mappable without a copy
+            values = table.column(i).to_numpy(zero_copy_only=False)
+            table = table.set_column(i, field, pyarrow.array(values, from_pandas=False))
+    tmp_path = f"{table_path}.{os.getpid()}.tmp"
+    with pyarrow.OSFile(tmp_path, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, table_path)
+    return meta
+
+
+def _read_shared_part(table_path, meta):
+    import pyarrow
+
+    table = pyarrow.ipc.open_file(pyarrow.memory_map(table_path)).read_all()
+    data = table.to_pandas(split_blocks=True)
+    if meta["freq"] is not None:
+        data.index.freq = meta["freq"]
+    if meta["series"]:
+        data = data["__series__"]
+        data.name = meta["name"]
+    return data
+
+
+def _read_shared(read, arguments):
+    """
+    Return the output of a read_* function from the shared cache, computing it
+    once per host
+    """
+    os.makedirs(shared_cache_dir, exist_ok=True)
+    files = [
+        [os.path.abspath(value), os.stat(value).st_mtime_ns, os.stat(value).st_size]
+        for name, value in arguments.items()
+        if name.endswith("_path")
+    ]
+    key = hashlib.sha256(
+        json.dumps(
+            [read.__name__, arguments, files], sort_keys=True, default=str
+        ).encode()
+    ).hexdigest()[:32]
+    meta_path = os.path.join(shared_cache_dir, f"{key}.json")
+    created = False
+    # only one process loads a dataset, the others wait and attach
+    with _lock_shared(key):
+        if not os.path.exists(meta_path):
+            output = read(**arguments)
+            parts = output if isinstance(output, tuple) else (output,)
+            meta = {
+                "tuple": isinstance(output, tuple),
+                "parts": [
+                    _write_shared_part(
+                        part, os.path.join(shared_cache_dir, f"{key}.{i}.arrow")
+                    )
+                    for i, part in enumerate(parts)
+                ],
+            }
+            # the description is written last and marks the entry complete
+            with open(f"{meta_path}.{os.getpid()}.tmp", "w") as fn:
+                json.dump(meta, fn)
+            os.replace(f"{meta_path}.{os.getpid()}.tmp", meta_path)
+            created = True
+        else:
+            with open(meta_path, "r") as fn:
+                meta = json.load(fn)
+        refs_dir = os.path.join(shared_cache_dir, f"{key}.refs")
+        os.makedirs(refs_dir, exist_ok=True)
+        open(os.path.join(refs_dir, str(os.getpid())), "w").close()
+        _shared_refs.add(key)
+        # modification time orders eviction by last use
+        os.utime(meta_path)
+        parts = [
+            _read_shared_part(
+                os.path.join(shared_cache_dir, f"{key}.{i}.arrow"), part_meta
+            )
+            for i, part_meta in enumerate(meta["parts"])
+        ]
+    if created:
+        evict_shared_cache(shared_cache_max_bytes)
+    return tuple(parts) if meta["tuple"] else parts[0]
+
+
+def _shared(read):
+    """
+    Serve a read_* function from the shared cache when shared_cache_dir is set,
+    keyed by its arguments and the size and modification time of its files
+    """
+    signature = inspect.signature(read)
+
+    @functools.wraps(read)
+    def read_shared(*args, **kwargs):
+        if shared_cache_dir is None:
+            return read(*args, **kwargs)
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        # engines differ in details such as missing values, so each has its own entry
+        if "engine" in arguments and arguments["engine"] is None:
+            arguments["engine"] = csv_engine
+        return _read_shared(read, arguments)
+
+    note = (
+        "With shared_cache_dir set the result is memory-mapped from the shared "
+        "cache: its columns are read-only and string columns are categorical."
+    )
+    read_shared.__doc__ = "\n".join(filter(None, [read.__doc__, note]))
+    return read_shared
+
+
+def _shared_bytes(key):
+    return sum(
+        os.path.getsize(table_path)
+        for table_path in glob.glob(os.path.join(shared_cache_dir, f"{key}.*.arrow"))
+    )
+
+
+def evict_shared_cache(max_bytes=0):
+    """
+    Remove datasets that no running process references from the shared cache,
+    least recently used first, until it is at most max_bytes in size
+    """
+    if shared_cache_dir is None or not os.path.isdir(shared_cache_dir):
+        return
+    meta_paths = sorted(
+        glob.glob(os.path.join(shared_cache_dir, "*.json")), key=os.path.getmtime
+    )
+    keys = [os.path.basename(meta_path)[: -len(".json")] for meta_path in meta_paths]
+    total_bytes = sum(_shared_bytes(key) for key in keys)
+    for key, meta_path in zip(keys, meta_paths):
+        if total_bytes <= max_bytes:
+            break
+        lock = _lock_shared(key, blocking=False)
+        if lock is None:
+            continue  # dataset is being loaded right now
+        with lock:
+            if not os.path.exists(meta_path) or _live_refs(key) > 0:
+                continue
+            total_bytes -= _shared_bytes(key)
+            # existing memory maps stay valid after the files are removed
+            os.remove(meta_path)
+            for table_path in glob.glob(
+                os.path.join(shared_cache_dir, f"{key}.*.arrow")
+            ):
+                os.remove(table_path)
+            shutil.rmtree(os.path.join(shared_cache_dir, f"{key}.refs"), True)
+            # removed while locked, waiting processes notice and lock the new file
+            os.remove(os.path.join(shared_cache_dir, f"{key}.lock"))
+
+
+@_shared
+def read_usa_temperature(
+    data_path="../.assets/data/climate/usa-avg-temp-monthly.csv", engine=None
+):
     def fahrenheit_to_celsius(f):
         c = (f - 32) * 5 / 9
         return c
 
-    usa_temp = pandas.read_csv(data_path, dtype={"Date": "str"})
-    # get parsable date format
-    usa_temp["Date"] = usa_temp["Date"].apply(lambda s: f"{s[:4]}-{s[4:]}")
+    usa_temp = _read_csv(
+        data_path,
+        engine=engine,
+        usecols=["Date", "Value", "Anomaly"],
+        dtype={"Date": "str", "Value": "float64", "Anomaly": "float64"},
+    )
     # convert units
-    usa_temp["Value"] = usa_temp["Value"].apply(fahrenheit_to_celsius)
-    usa_temp["Anomaly"] = usa_temp["Anomaly"].apply(fahrenheit_to_celsius)
-    # datetime index
-    usa_temp["Date"] = pandas.to_datetime(usa_temp["Date"])
+    usa_temp["Value"] = fahrenheit_to_celsius(usa_temp["Value"])
+    usa_temp["Anomaly"] = fahrenheit_to_celsius(usa_temp["Anomaly"])
+    # datetime index from YYYYMM
+    usa_temp["Date"] = pandas.to_datetime(usa_temp["Date"], format="%Y%m")
     usa_temp = usa_temp.set_index("Date")
     return usa_temp
 
 
-def read_chicago_taxi_trips(data_path, freq="d"):
-    taxi_data = pandas.read_csv(
-        data_path, parse_dates=["Trip Start Timestamp", "Trip End Timestamp"]
+@_shared
+def read_chicago_taxi_trips(
+    data_path, freq="d", date_format="%m/%d/%Y %I:%M:%S %p", engine=None
+):
+    # only the trip start is needed to count trips
+    taxi_data = _read_csv(
+        data_path,
+        engine=engine,
+        usecols=["Trip Start Timestamp"],
+        dtype={"Trip Start Timestamp": "str"},
+    )
+    taxi_data["Trip Start Timestamp"] = pandas.to_datetime(
+        taxi_data["Trip Start Timestamp"], format=date_format
     )
     taxi_data = taxi_data.set_index("Trip Start Timestamp")
     taxi_trips = taxi_data.resample(freq).size()
@@ -33,26 +342,49 @@ def read_chicago_taxi_trips(data_path, freq="d"):
     return taxi_trips
 
 
+@_shared
 def read_chicago_taxi_trips_daily(
     data_path="../.assets/data/taxi/taxi_trips_daily.csv",
+    engine=None,
 ):
-    taxi_trips = pandas.read_csv(data_path, sep=";", parse_dates=["Date"])
+    taxi_trips = _read_csv(
+        data_path,
+        engine=engine,
+        sep=";",
+        usecols=["Date", "Trips"],
+        dtype={"Trips": "int64"},
+        parse_dates=["Date"],
+    )
     taxi_trips = taxi_trips.set_index("Date")
     # taxi_trips["Trips"].freq = pandas.Timedelta('1 day')
     return taxi_trips
 
 
-def read_iris(data_path="../.assets/data/iris/iris.csv"):
-    data = pandas.read_csv(data_path, sep=",")
+@_shared
+def read_iris(data_path="../.assets/data/iris/iris.csv", engine=None):
+    data = _read_csv(
+        data_path,
+        engine=engine,
+        sep=",",
+        dtype={
+            "sepal length (cm)": "float64",
+            "sepal width (cm)": "float64",
+            "petal length (cm)": "float64",
+            "petal width (cm)": "float64",
+            "species": "int64",
+        },
+    )
     return data
 
 
+@_shared
 def read_house_prices(
     data_path="../.assets/data/house/prices.csv",
     encode_ordinal=True,
     drop_sparse=True,
     encode_categorial=True,
     drop_first_level=False,
+    engine=None,
 ):
     target = "SalePrice"
     numeric = [
@@ -149,9 +481,14 @@ def read_house_prices(
         "CentralAir",
         "Functional",
     ]
-    # read file
-    data = pandas.read_csv(data_path)
-    data = data.drop("Id", axis="columns")
+    # read file, skipping columns that are dropped anyway
+    header = pandas.read_csv(data_path, nrows=0).columns
+    usecols = [
+        column
+        for column in header
+        if column != "Id" and not (drop_sparse and column in sparse)
+    ]
+    data = _read_csv(data_path, engine=engine, usecols=usecols)
     # encode ordinal
     qual_dict = {"Ex": 1, "Gd": 2, "TA": 3, "Fa": 4, "Po": 5, "NA": 6, numpy.nan: 6}
     if drop_sparse:
@@ -174,15 +511,209 @@ def read_house_prices(
     return data
 
 
-def read_titanic(data_path="../.assets/data/titanic/titanic.csv"):
-    data = pandas.read_csv(data_path)
+@_shared
+def read_titanic(data_path="../.assets/data/titanic/titanic.csv", engine=None):
+    data = _read_csv(
+        data_path,
+        engine=engine,
+        dtype={
+            "PassengerId": "int64",
+            "Survived": "int64",
+            "Pclass": "int64",
+            "Name": "str",
+            "Sex": "str",
+            "Age": "float64",
+            "SibSp": "int64",
+            "Parch": "int64",
+            "Ticket": "str",
+            "Fare": "float64",
+            "Cabin": "str",
+            "Embarked": "str",
+        },
+    )
     return data
 
 
+@_shared
 def read_house_prices_seattle(
     data_path="../.assets/data/houses_seattle/kc_house_data.csv",
     descr_path="../.assets/data/houses_seattle/description.csv",
+    engine=None,
 ):
-    data = pandas.read_csv(data_path, sep=",", parse_dates=["date"], engine='python')
-    data_descr = pandas.read_csv(descr_path, sep=", ", engine='python')
+    data = _read_csv(
+        data_path,
+        engine=engine,
+        sep=",",
+        dtype={
+            "id": "int64",
+            "date": "str",
+            "price": "float64",
+            "bedrooms": "int64",
+            "bathrooms": "float64",
+            "sqft_living": "int64",
+            "sqft_lot": "int64",
+            "floors": "float64",
+            "waterfront": "int64",
+            "view": "int64",
+            "condition": "int64",
+            "grade": "int64",
+            "sqft_above": "int64",
+            "sqft_basement": "int64",
+            "yr_built": "int64",
+            "yr_renovated": "int64",
+            "zipcode": "int64",
+            "lat": "float64",
+            "long": "float64",
+            "sqft_living15": "int64",
+            "sqft_lot15": "int64",
+        },
+    )
+    data["date"] = pandas.to_datetime(data["date"], format="%Y%m%dT%H%M%S")
+    # small file with ", " separators, pyarrow has no skipinitialspace
+    data_descr = pandas.read_csv(descr_path, sep=",", skipinitialspace=True, engine="c")
     return data, data_descr
+
+
+def _chunks(n_rows, chunk_size, seed):
+    # one random generator per chunk keeps the output reproducible
+    for i, start in enumerate(range(0, n_rows, chunk_size)):
+        yield start, min(chunk_size, n_rows - start), numpy.random.default_rng(
+            [seed, i]
+        )
+
+
+def _resample(source, size, rng):
+    rows = rng.integers(0, len(source), size)
+    return source.iloc[rows].reset_index(drop=True)
+
+
+def write_synthetic_csv(chunks, data_path, sep=",", **kwargs):
+    """
+    Write the chunks of a generate_* function to a single CSV file
+    """
+    for i, chunk in enumerate(chunks):
+        chunk.to_csv(
+            data_path,
+            sep=sep,
+            index=False,
+            header=(i == 0),
+            mode="w" if i == 0 else "a",
+            **kwargs,
+        )
+
+
+def generate_iris(
+    n_rows, seed=0, chunk_size=1_000_000, data_path="../.assets/data/iris/iris.csv"
+):
+    """
+    Yield chunks with the schema of the iris data, drawn from a multivariate
+    normal distribution per species fitted to the shipped data
+    """
+    source = read_iris(data_path)
+    features = source.columns.drop("species")
+    species = numpy.sort(source["species"].unique())
+    means = [
+        source.loc[source["species"] == s, features].mean().to_numpy() for s in species
+    ]
+    factors = [
+        numpy.linalg.cholesky(
+            source.loc[source["species"] == s, features].cov().to_numpy()
+        )
+        for s in species
+    ]
+    for start, size, rng in _chunks(n_rows, chunk_size, seed):
+        labels = rng.integers(0, len(species), size)
+        values = rng.standard_normal((size, len(features)))
+        for i in range(len(species)):
+            mask = labels == i
+            values[mask] = means[i] + values[mask] @ factors[i].T
+        chunk = pandas.DataFrame(
+            numpy.clip(values, 0.1, None).round(1), columns=features
+        )
+        chunk["species"] = species[labels]
+        yield chunk
+
+
+def generate_titanic(
+    n_rows,
+    seed=0,
+    chunk_size=1_000_000,
+    data_path="../.assets/data/titanic/titanic.csv",
+):
+    """
+    Yield chunks with the schema of the titanic data, resampled from the
+    shipped passengers with jittered ages and fares
+    """
+    source = read_titanic(data_path)
+    for start, size, rng in _chunks(n_rows, chunk_size, seed):
+        chunk = _resample(source, size, rng)
+        chunk["PassengerId"] = numpy.arange(start + 1, start + size + 1)
+        # whole-year jitter keeps fractional and estimated (xx.5) ages, infants
+        # and jitters that would drop below one year keep the resampled age
+        age = chunk["Age"] + rng.normal(0, 2, size).round()
+        chunk["Age"] = age.where((chunk["Age"] >= 1) & (age >= 1), chunk["Age"])
+        chunk["Fare"] = (chunk["Fare"] * rng.lognormal(0, 0.1, size)).round(4)
+        yield chunk
+
+
+def generate_house_prices(
+    n_rows, seed=0, chunk_size=1_000_000, data_path="../.assets/data/house/prices.csv"
+):
+    """
+    Yield chunks with the schema of the raw house prices data, resampled from
+    the shipped houses with jittered lot areas and sale prices. Write them
+    with na_rep="NA" to match the original file.
+    """
+    source = _read_csv(data_path)
+    for start, size, rng in _chunks(n_rows, chunk_size, seed):
+        chunk = _resample(source, size, rng)
+        chunk["Id"] = numpy.arange(start + 1, start + size + 1)
+        chunk["LotArea"] = (
+            (chunk["LotArea"] * rng.lognormal(0, 0.05, size)).round().astype("int64")
+        )
+        chunk["SalePrice"] = (
+            (chunk["SalePrice"] * rng.lognormal(0, 0.05, size)).round().astype("int64")
+        )
+        yield chunk
+
+
+def _format_timestamps(timestamps, date_format):
+    # timestamps are rounded to 15 minutes, so only few distinct values need formatting
+    values, inverse = numpy.unique(timestamps, return_inverse=True)
+    return pandas.DatetimeIndex(values).strftime(date_format).to_numpy()[inverse]
+
+
+def generate_chicago_taxi_trips(
+    n_rows,
+    seed=0,
+    chunk_size=1_000_000,
+    date_format="%m/%d/%Y %I:%M:%S %p",
+    data_path="../.assets/data/taxi/taxi_trips_daily.csv",
+):
+    """
+    Yield chunks of individual taxi trips as expected by read_chicago_taxi_trips,
+    with start days distributed like the shipped daily trip counts
+    """
+    daily = read_chicago_taxi_trips_daily(data_path)
+    days = daily.index.to_numpy()
+    day_probs = (daily["Trips"] / daily["Trips"].sum()).to_numpy()
+    slot = numpy.timedelta64(15, "m")
+    for start, size, rng in _chunks(n_rows, chunk_size, seed):
+        seconds = rng.lognormal(numpy.log(720), 0.8, size).round().astype("int64")
+        miles = (seconds * rng.lognormal(numpy.log(0.004), 0.4, size)).round(1)
+        # timestamps are rounded to 15 minutes as in the published data
+        start_times = (
+            days[rng.choice(len(days), size, p=day_probs)]
+            + rng.integers(0, 96, size) * slot
+        )
+        end_times = start_times + (seconds / 900).round().astype("int64") * slot
+        yield pandas.DataFrame(
+            {
+                "Trip ID": numpy.arange(start + 1, start + size + 1),
+                "Trip Start Timestamp": _format_timestamps(start_times, date_format),
+                "Trip End Timestamp": _format_timestamps(end_times, date_format),
+                "Trip Seconds": seconds,
+                "Trip Miles": miles,
+                "Fare": (3.25 + 2.25 * miles + 0.20 * seconds / 36).round(2),
+            }
+        )
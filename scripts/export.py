@@ -1,10 +1,33 @@
 import os
+import base64
 import glob
+import gzip
+import hashlib
+import re
 import subprocess
 import shutil
 import optparse
 import pprint
 
+from nbconvert import HTMLExporter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# base64 embedded images in exported HTML
+embedded_image_pattern = re.compile(
+    r"""(["'])data:image/(png|jpeg|gif|svg\+xml);base64,([A-Za-z0-9+/=\s]+)\1"""
+)
+image_extensions = {"png": "png", "jpeg": "jpg", "gif": "gif", "svg+xml": "svg"}
+# blocks whose whitespace is significant
+preserved_block_pattern = re.compile(
+    r"(<(pre|script|style|textarea)\b.*?</\2>)", re.IGNORECASE | re.DOTALL
+)
+# extensions that get gzip/brotli siblings
+precompressed_extensions = (".html", ".svg")
+
 # folders from the blocklist are deleted
 blocklist = [
     "notebooks/exercises/churn",
@@ -38,7 +61,7 @@ def copy_notebooks(proj_dir, export_dir):
     nb_export_dir = os.path.join(export_dir, "notebooks")
     shutil.copytree(nb_dir, nb_export_dir)
 
-def export_html(export_dir):
+def export_html(export_dir, pool=None):
 
     list_of_nbs = list(
             glob.iglob(
@@ -61,12 +84,25 @@ def export_html(export_dir):
         try:
             print(f"EXPORTING {nb_path}")
             # run notebook and export to html
-            subprocess.call(
-                f"jupyter nbconvert --ExecutePreprocessor.timeout=300 --execute --to html {nb_path}",
-                shell=True
-            )
-            # Replace .ipynb file extension by .html for all link targets in html output file
             html_path = nb_path.replace(".ipynb", ".html")
+            if pool is not None:
+                nb = pool.execute(nb_path, timeout=300)
+                # the page title comes from the notebook name, as with nbconvert --to html
+                resources = {
+                    "metadata": {
+                        "name": os.path.splitext(os.path.basename(nb_path))[0],
+                        "path": os.path.dirname(nb_path),
+                    }
+                }
+                body, _ = HTMLExporter().from_notebook_node(nb, resources=resources)
+                with open(html_path, 'w') as fn:
+                  fn.write(body)
+            else:
+                subprocess.call(
+                    f"jupyter nbconvert --ExecutePreprocessor.timeout=300 --execute --to html {nb_path}",
+                    shell=True
+                )
+            # Replace .ipynb file extension by .html for all link targets in html output file
             # Read in the file
             with open(html_path, 'r') as fn:
               filedata = fn.read()
@@ -85,6 +121,68 @@ def export_html(export_dir):
     if error_nbs:
         print(f"ERROR: not exported: {error_nbs}")
 
+def extract_images(html, page_dir, assets_dir):
+    """Replace embedded images by links to content-addressed files"""
+    def replace(match):
+        quote, image_type, data = match.groups()
+        content = base64.b64decode(data)
+        file_name = f"{hashlib.sha256(content).hexdigest()[:20]}.{image_extensions[image_type]}"
+        asset_path = os.path.join(assets_dir, file_name)
+        if not os.path.exists(asset_path):
+            with open(asset_path, 'wb') as fn:
+                fn.write(content)
+        link = os.path.relpath(asset_path, page_dir).replace(os.sep, "/")
+        return f"{quote}{link}{quote}"
+    return embedded_image_pattern.sub(replace, html)
+
+def minify_html(html):
+    """Collapse whitespace outside of blocks where it is significant"""
+    parts = preserved_block_pattern.split(html)
+    minified = []
+    # split returns text, block, tag name, text, block, tag name, ...
+    for i in range(0, len(parts), 3):
+        text = re.sub(r"\s*\n\s*", "\n", parts[i])
+        minified.append(re.sub(r"[ \t]+", " ", text))
+        if i + 1 < len(parts):
+            minified.append(parts[i + 1])
+    return "".join(minified)
+
+def precompress(path):
+    """Write gzip and, if available, brotli compressed siblings of a file"""
+    with open(path, 'rb') as fn:
+        content = fn.read()
+    with open(f"{path}.gz", 'wb') as fn:
+        fn.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(f"{path}.br", 'wb') as fn:
+            fn.write(brotli.compress(content))
+
+def optimize_html(export_dir):
+    """Deduplicate embedded images, minify and precompress the HTML export"""
+    nb_export_dir = os.path.join(export_dir, "notebooks")
+    assets_dir = os.path.join(nb_export_dir, "html_assets")
+    os.makedirs(assets_dir, exist_ok=True)
+    bytes_before = 0
+    bytes_after = 0
+    for html_path in sorted(glob.iglob(f"{nb_export_dir}/**/*.html", recursive=True)):
+        with open(html_path, 'r') as fn:
+            html = fn.read()
+        bytes_before += len(html.encode())
+        html = extract_images(html, os.path.dirname(html_path), assets_dir)
+        html = minify_html(html)
+        bytes_after += len(html.encode())
+        with open(html_path, 'w') as fn:
+            fn.write(html)
+    for asset_name in os.listdir(assets_dir):
+        bytes_after += os.path.getsize(os.path.join(assets_dir, asset_name))
+    if brotli is None:
+        print("WARNING: brotli not installed, writing gzip only")
+    for root, _, file_names in os.walk(nb_export_dir):
+        for file_name in file_names:
+            if file_name.endswith(precompressed_extensions):
+                precompress(os.path.join(root, file_name))
+    print(f"DONE: HTML optimized, {bytes_before - bytes_after} bytes saved ({bytes_before} -> {bytes_after})")
+
 def copy_library(proj_dir, export_dir):
     """Copy the library"""
     lib_dir = os.path.join(proj_dir, "library")
@@ -108,10 +206,38 @@ if __name__ == "__main__":
         default=False,
         help="flag for HTML export"
     )
+    parser.add_option(
+        "--pool_size",
+        dest="pool_size",
+        type="int",
+        default=2,
+        help="number of pre-warmed kernels, 0 runs every notebook through nbconvert"
+    )
+    parser.add_option(
+        "--preload",
+        dest="preload",
+        help="comma separated modules to import into pre-warmed kernels (default: pandas,data_science_learning_paths)"
+    )
+    parser.add_option(
+        "--optimize_html",
+        dest="optimize_html",
+        action="store_true",
+        default=False,
+        help="flag to deduplicate images, minify and precompress the HTML export"
+    )
     (options, args) = parser.parse_args()
     copy_notebooks('.', options.export_dir)
     copy_library('.', options.export_dir)
     remove_blocklisted(options.export_dir)
     if options.to_html:
-        export_html(options.export_dir)
+        if options.pool_size > 0:
+            from kernel_pool import KernelPool
+
+            preload = options.preload.split(",") if options.preload is not None else None
+            with KernelPool(size=options.pool_size, preload=preload) as pool:
+                export_html(options.export_dir, pool=pool)
+        else:
+            export_html(options.export_dir)
+        if options.optimize_html:
+            optimize_html(options.export_dir)
     remove_pycache(options.export_dir)
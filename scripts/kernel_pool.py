@@ -0,0 +1,126 @@
+import collections
+import concurrent.futures
+import os
+
+import nbclient
+import nbformat
+from jupyter_client import KernelManager
+
+# modules imported into every pooled kernel before it is handed out, kept small
+# because idle kernels hold their memory; heavier ones like tensorflow via --preload
+default_preload = [
+    "pandas",
+    "data_science_learning_paths",
+]
+
+
+def _ignore_output(msg):
+    pass
+
+
+class KernelPool:
+    """
+    Pool of pre-started kernels that have already imported heavy modules.
+    Every notebook gets its own kernel, which is shut down afterwards, while
+    replacement kernels are started in the background.
+    """
+
+    def __init__(self, size=2, kernel_name="python3", preload=None, startup_timeout=120):
+        self.kernel_name = kernel_name
+        self.preload = default_preload if preload is None else preload
+        self.startup_timeout = startup_timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+        self._kernels = collections.deque(
+            self._executor.submit(self._start_kernel) for _ in range(size)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, km, code):
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            reply = kc.execute_interactive(
+                code,
+                store_history=False,
+                timeout=self.startup_timeout,
+                output_hook=_ignore_output,
+            )
+        finally:
+            kc.stop_channels()
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(f"kernel setup failed: {code}")
+
+    def _start_kernel(self):
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        # import into sys.modules only, notebooks must not see names they never imported,
+        # and modules missing in the environment must not break the kernel
+        code = (
+            "def _preload(modules):\n"
+            "    import importlib\n"
+            "    for module in modules:\n"
+            "        try:\n"
+            "            importlib.import_module(module)\n"
+            "        except ImportError:\n"
+            "            pass\n"
+            f"_preload({list(self.preload)!r})\n"
+            "del _preload"
+        )
+        try:
+            self._run(km, code)
+        except:
+            km.shutdown_kernel(now=True)
+            raise
+        return km
+
+    def _checkout(self):
+        """Take a warm kernel and start a replacement in the background"""
+        future = self._kernels.popleft()
+        # queue the replacement first, a kernel that failed to start must not shrink the pool
+        self._kernels.append(self._executor.submit(self._start_kernel))
+        return future.result()
+
+    def execute(self, nb_path, timeout, monitor=None):
+        """
+        Execute a notebook in its own directory and return the executed
+        notebook, an optional MemoryMonitor is attached to the kernel process
+        """
+        nb = nbformat.read(nb_path, as_version=4)
+        nb_dir = os.path.dirname(os.path.abspath(nb_path))
+        resources = {"metadata": {"path": nb_dir}}
+        kernel_name = nb.metadata.get("kernelspec", {}).get("name", self.kernel_name)
+        if kernel_name != self.kernel_name:
+            # other kernels, e.g. Julia, are started fresh
+            km = KernelManager(kernel_name=kernel_name)
+            km.start_kernel(cwd=nb_dir)
+        else:
+            km = self._checkout()
+        try:
+            if kernel_name == self.kernel_name:
+                self._run(km, f"import os\nos.chdir({nb_dir!r})\ndel os")
+            if monitor is not None:
+                monitor.start(km.provisioner.pid)
+            nbclient.NotebookClient(
+                nb, km=km, timeout=timeout, resources=resources
+            ).execute()
+        finally:
+            if monitor is not None:
+                monitor.stop()
+            km.shutdown_kernel(now=True)
+        return nb
+
+    def close(self):
+        """Shut down all kernels waiting in the pool"""
+        while self._kernels:
+            future = self._kernels.popleft()
+            try:
+                future.result().shutdown_kernel(now=True)
+            except:
+                pass
+        self._executor.shutdown()
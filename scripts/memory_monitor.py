@@ -0,0 +1,60 @@
+import threading
+
+import psutil
+
+
+class MemoryMonitor:
+    """
+    Sample the total RSS of a process and its children in the background,
+    record the peak and kill the process tree when it exceeds the limit
+    """
+
+    def __init__(self, limit=None, interval=0.5):
+        self.limit = limit  # bytes, None for no limit
+        self.interval = interval  # seconds between samples
+        self.peak_rss = 0
+        self.exceeded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _processes(self):
+        return [self._process] + self._process.children(recursive=True)
+
+    def _rss(self):
+        rss = 0
+        for process in self._processes():
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass  # child exited between listing and sampling
+        return rss
+
+    def _kill(self):
+        for process in self._processes():
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+    def _sample(self):
+        while not self._stop.is_set():
+            try:
+                rss = self._rss()
+            except psutil.Error:
+                return  # process tree has exited
+            self.peak_rss = max(self.peak_rss, rss)
+            if self.limit is not None and rss > self.limit:
+                self.exceeded = True
+                self._kill()
+                return
+            self._stop.wait(self.interval)
+
+    def start(self, pid):
+        self._process = psutil.Process(pid)
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
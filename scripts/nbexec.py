@@ -1,9 +1,20 @@
 import glob
+import heapq
+import json
+import optparse
+import os
 import subprocess
 import sys
 import pprint
+import time
 
-def test_notebooks():
+from memory_monitor import MemoryMonitor
+
+# fallback runtime estimate when no notebook has a recorded duration
+default_seconds_per_byte = 0.001
+
+
+def find_notebooks():
     list_of_nbs = list(
             glob.iglob(
                 f"notebooks/**/*.ipynb",
@@ -15,43 +26,260 @@ def test_notebooks():
             f"notebooks/**/wip_*.ipynb"
         )
     )
+    return sorted(list(set(list_of_nbs) - set(wip_nbs)))
+
+
+def read_durations(durations_path):
+    """Read recorded notebook runtimes in seconds, keyed by notebook path"""
+    if durations_path is None or not os.path.exists(durations_path):
+        return {}
+    with open(durations_path, "r") as fn:
+        return json.load(fn)
+
+
+def estimate_durations(list_of_nbs, durations):
+    """Estimate runtimes, falling back to notebook file size without history"""
+    known = [nb for nb in list_of_nbs if nb in durations]
+    known_bytes = sum(os.path.getsize(nb) for nb in known)
+    if known_bytes > 0:
+        seconds_per_byte = sum(durations[nb] for nb in known) / known_bytes
+    else:
+        seconds_per_byte = default_seconds_per_byte
+    return {
+        nb: durations[nb] if nb in durations
+        else os.path.getsize(nb) * seconds_per_byte
+        for nb in list_of_nbs
+    }
+
+
+def shard_notebooks(list_of_nbs, shard_index, shard_count, durations):
+    """
+    Split notebooks into shard_count shards of about equal runtime using
+    greedy longest-first assignment, return the notebooks of shard_index
+    (counted from 1)
+    """
+    estimates = estimate_durations(list_of_nbs, durations)
+    shards = [(0.0, i, []) for i in range(shard_count)]
+    for nb in sorted(list_of_nbs, key=lambda nb: (-estimates[nb], nb)):
+        load, i, nbs = heapq.heappop(shards)
+        nbs.append(nb)
+        heapq.heappush(shards, (load + estimates[nb], i, nbs))
+    shard = next(nbs for _, i, nbs in shards if i == shard_index - 1)
+    return sorted(shard)
+
+
+def parse_shard(shard):
+    """Parse a shard specification of the form i/N"""
+    try:
+        shard_index, shard_count = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard, expected i/N: {shard}")
+    if not 1 <= shard_index <= shard_count:
+        raise ValueError(f"invalid shard, expected 1 <= i <= N: {shard}")
+    return shard_index, shard_count
 
 
-    list_of_nbs = sorted(list(set(list_of_nbs) - set(wip_nbs)))
+def read_memory_limits(memory_limits_path):
+    """Read per-notebook memory limits in MB, keyed by notebook path"""
+    if memory_limits_path is None:
+        return {}
+    with open(memory_limits_path, "r") as fn:
+        return json.load(fn)
+
+
+def test_notebooks(list_of_nbs, pool=None, memory_limit=None, memory_limits=None):
     print("TESTING: ")
     pprint.pprint(list_of_nbs)
     if not len(list_of_nbs) > 0:
         print("ERROR: no notebooks found")
         sys.exit(1)
 
-    error_nbs = []  # notebooks with errors
+    results = {}  # notebook path -> exit code, duration and peak memory
 
     # run notebooks before export
     for nb_path in list_of_nbs:
+        start = time.monotonic()
+        limit_mb = (memory_limits or {}).get(nb_path, memory_limit)
+        monitor = MemoryMonitor(limit=limit_mb * 1024**2 if limit_mb else None)
         try:
             print(f"EXPORTING {nb_path}")
-            # run notebook and export to html
-            exit_code =subprocess.call(
-                f"jupyter nbconvert --ExecutePreprocessor.timeout=1200 --execute --clear-output {nb_path}",
-                shell=True
-            )
+            if pool is not None:
+                # run notebook in a pre-warmed kernel
+                pool.execute(nb_path, timeout=1200, monitor=monitor)
+                exit_code = 0
+            else:
+                # run notebook and export to html
+                process = subprocess.Popen(
+                    f"jupyter nbconvert --ExecutePreprocessor.timeout=1200 --execute --clear-output {nb_path}",
+                    shell=True
+                )
+                monitor.start(process.pid)
+                try:
+                    exit_code = process.wait()
+                finally:
+                    monitor.stop()
             if exit_code != 0:
                 print(f"ERROR: {nb_path}")
-                error_nbs.append(nb_path)
         except KeyboardInterrupt:
             print("ABORTED")
-            return error_nbs
-        except:
+            return results
+        except Exception as e:
             print(f"ERROR: {nb_path}")
-            error_nbs.append(nb_path)
-    return error_nbs
+            if not monitor.exceeded:
+                print(e)
+            exit_code = 1
+        if monitor.exceeded:
+            print(f"ERROR: {nb_path} exceeded the memory limit of {limit_mb} MB")
+            exit_code = 1
+        results[nb_path] = {
+            "exit_code": exit_code,
+            "duration": time.monotonic() - start,
+            "peak_rss": monitor.peak_rss,
+            "memory_limit_exceeded": monitor.exceeded,
+        }
+    return results
 
-if __name__ == "__main__":
-    error_nbs = test_notebooks()
-    if len(error_nbs) == 0:
+
+def merge_results(results_paths):
+    """Combine the results files of several shards"""
+    results = {}
+    for results_path in results_paths:
+        with open(results_path, "r") as fn:
+            shard_results = json.load(fn)
+        duplicate_nbs = sorted(set(results) & set(shard_results))
+        if duplicate_nbs:
+            # shards split with different recorded durations
+            print(f"WARNING: notebooks ran in more than one shard: {duplicate_nbs}")
+        results.update(shard_results)
+    return results
+
+
+def write_json(data, path):
+    with open(path, "w") as fn:
+        json.dump(data, fn, indent=1, sort_keys=True)
+
+
+def report_memory(results, top=10):
+    """Print the notebooks with the highest peak memory"""
+    ranked = sorted(
+        results.items(), key=lambda item: item[1].get("peak_rss", 0), reverse=True
+    )
+    print("MEMORY: peak RSS of the heaviest notebooks")
+    for nb, result in ranked[:top]:
+        print(f"{result.get('peak_rss', 0) / 1024**2:10.0f} MB  {nb}")
+
+
+def report(results, list_of_nbs):
+    report_memory(results)
+    error_nbs = sorted(nb for nb, result in results.items() if result["exit_code"] != 0)
+    missing_nbs = sorted(set(list_of_nbs) - set(results))
+    if len(error_nbs) == 0 and len(missing_nbs) == 0:
         print("SUCCESS: all notebooks working")
         sys.exit(0)
-    else:
+    if error_nbs:
         print("FAILURE: the following notebooks threw exceptions:")
         pprint.pprint(error_nbs)
-        sys.exit(1)
+    if missing_nbs:
+        print("FAILURE: the following notebooks were not run:")
+        pprint.pprint(missing_nbs)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] [--merge results.json ...]")
+    parser.add_option(
+        "--shard",
+        dest="shard",
+        help="run only shard i of N (i/N, counted from 1), balanced by recorded durations"
+    )
+    parser.add_option(
+        "--durations",
+        dest="durations",
+        default="scripts/nbexec_durations.json",
+        help="path to JSON file with recorded notebook durations"
+    )
+    parser.add_option(
+        "--results",
+        dest="results",
+        help="path to write the JSON results (exit code and duration per notebook)"
+    )
+    parser.add_option(
+        "--merge",
+        dest="merge",
+        action="store_true",
+        default=False,
+        help="merge the results files given as arguments into one report"
+    )
+    parser.add_option(
+        "--memory_limit",
+        dest="memory_limit",
+        type="int",
+        help="fail notebooks whose kernel exceeds this peak RSS in MB"
+    )
+    parser.add_option(
+        "--memory_limits",
+        dest="memory_limits",
+        help="path to JSON file with per-notebook memory limits in MB"
+    )
+    parser.add_option(
+        "--pool_size",
+        dest="pool_size",
+        type="int",
+        default=2,
+        help="number of pre-warmed kernels, 0 runs every notebook through nbconvert"
+    )
+    parser.add_option(
+        "--preload",
+        dest="preload",
+        help="comma separated modules to import into pre-warmed kernels (default: pandas,data_science_learning_paths)"
+    )
+    (options, args) = parser.parse_args()
+
+    if options.merge:
+        results = merge_results(args)
+        if options.results:
+            write_json(results, options.results)
+        # update the recorded durations of successful runs for the next sharded run
+        durations = read_durations(options.durations)
+        durations.update({
+            nb: result["duration"] for nb, result in results.items()
+            if result["exit_code"] == 0
+        })
+        write_json(durations, options.durations)
+        # a crashed shard or shards split differently leave notebooks without results
+        report(results, find_notebooks())
+
+    list_of_nbs = find_notebooks()
+    if options.shard:
+        try:
+            shard_index, shard_count = parse_shard(options.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        list_of_nbs = shard_notebooks(
+            list_of_nbs, shard_index, shard_count, read_durations(options.durations)
+        )
+        if not list_of_nbs:
+            print(f"SKIPPED: shard {options.shard} has no notebooks")
+            if options.results:
+                write_json({}, options.results)
+            sys.exit(0)
+    if options.pool_size > 0:
+        from kernel_pool import KernelPool
+
+        preload = options.preload.split(",") if options.preload is not None else None
+        with KernelPool(size=options.pool_size, preload=preload) as pool:
+            results = test_notebooks(
+                list_of_nbs,
+                pool=pool,
+                memory_limit=options.memory_limit,
+                memory_limits=read_memory_limits(options.memory_limits),
+            )
+    else:
+        results = test_notebooks(
+            list_of_nbs,
+            memory_limit=options.memory_limit,
+            memory_limits=read_memory_limits(options.memory_limits),
+        )
+    if options.results:
+        write_json(results, options.results)
+    report(results, list_of_nbs)